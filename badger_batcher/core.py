@@ -1,7 +1,190 @@
 """Core functionality"""
+from functools import lru_cache
+from itertools import islice
 from .errors import RecordSizeExceeded
-from .utils import CacheIterator
-from typing import Any, Callable, Iterable, Optional, List
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, List
+
+# Marks that there is no record cached from the previous batch,
+# as any value, including None, can be a record
+_MISSING = object()
+
+# Iteration state of a Batcher that is not iterated yet, or is consumed
+_EXHAUSTED: Iterator[Any] = iter(())
+
+
+def _stop_iteration(_self: Any, _it: Iterator[Any]) -> List[Any]:
+    """
+    __next__ implementation of a Batcher that is not iterated yet, or is consumed.
+
+    :raises StopIteration: always
+    """
+    raise StopIteration
+
+
+# Values of when_record_size_exceeded, mapped to ints compared during iteration
+_RAISES = 0
+_SKIP = 1
+_EXCEED_MODES = {"raises": _RAISES, "skip": _SKIP}
+
+# Batches up to this max len are preallocated instead of appended to
+_MAX_PREALLOCATED_LEN = 1024
+
+
+@lru_cache(maxsize=None)
+def _compile_next(
+    max_batch_len: bool,
+    max_record_size: bool,
+    max_batch_size: bool,
+    size_is_len: bool,
+    skip: bool,
+    reuse_batch: bool,
+    prealloc: bool,
+    all_batches: bool = False,
+) -> Callable[[Any, Iterator[Any]], Any]:
+    """
+    Generates Batcher.__next__ loop specialized for the given configuration.
+
+    The configuration is fixed for the whole iteration, so checks for
+    the limits that are not in use are left out from the generated code,
+    instead of re-checking them for every record.
+    The limits and size_calc_fn are read from the Batcher when the function
+    is called, so the generated function is cached and shared
+    between Batchers with the same shape of configuration.
+
+    >>> next_fn = _compile_next(True, False, False, False, False, False, False)
+    >>> class State:
+    ...     _pushback = _MISSING
+    ...     max_batch_len = 2
+    >>> state = State()
+    >>> it = iter([1, 2, 3])
+    >>> next_fn(state, it), next_fn(state, it)
+    ([1, 2], [3])
+
+    With all_batches, the generated loop collects all batches in one call:
+
+    >>> batches_fn = _compile_next(
+    ...     True, False, False, False, False, False, False, all_batches=True
+    ... )
+    >>> batches_fn(State(), iter([1, 2, 3]))
+    [[1, 2], [3]]
+
+    :param max_batch_len: True if max_batch_len is used
+    :param max_record_size: True if max_record_size is checked in the loop
+    :param max_batch_size: True if max_batch_size is used
+    :param size_is_len: True if size_calc_fn is the builtin len
+    :param skip: True if too large records should be skipped, False if raised
+    :param reuse_batch: True if self._batch_buf is used as the batch
+    :param prealloc: True if the batch is preallocated to max_batch_len,
+        and filled by index
+    :param all_batches: True if the function should return all batches
+        instead of the next one
+    :return: function (self, record_iterator) -> next batch, or all batches
+    """
+    calc_size = max_record_size or max_batch_size
+
+    # The config is bound to locals once per call,
+    # and the builtin len is called directly instead of through size_fn
+    size_fn = "len" if size_is_len else "size_fn"
+    lines = [
+        "def _next(self, it, _MISSING=_MISSING, _EXHAUSTED=_EXHAUSTED, "
+        "_stop_iteration=_stop_iteration):"
+    ]
+    if max_batch_len:
+        lines += ["    max_len = self.max_batch_len"]
+    if max_record_size:
+        lines += ["    max_rec = self.max_record_size"]
+    if max_batch_size:
+        lines += ["    max_bs = self.max_batch_size"]
+    if calc_size and not size_is_len:
+        lines += ["    size_fn = self.size_calc_fn"]
+    if all_batches:
+        lines += ["    result = []"]
+    if reuse_batch:
+        lines += ["    batch = self._batch_buf", "    batch.clear()"]
+    elif prealloc:
+        lines += ["    batch = [None] * max_len", "    i = 0"]
+    else:
+        lines += ["    batch = []"]
+    if max_batch_size:
+        lines += ["    cur = 0"]
+    if not all_batches:
+        # Handle cached record from the previous batch
+        lines += ["    cache = self._pushback", "    if cache is not _MISSING:"]
+        if prealloc:
+            lines += ["        batch[0] = cache", "        i = 1"]
+        else:
+            lines += ["        batch.append(cache)"]
+        lines += ["        self._pushback = _MISSING"]
+        if max_batch_size:
+            lines += [f"        cur = {size_fn}(cache)"]
+
+    if not (max_batch_len or calc_size):
+        lines += ["    batch.extend(it)"]
+    else:
+        split = ["del batch[i:]"] if prealloc else []
+        if all_batches:
+            split += ["result.append(batch)"]
+            # The record that triggered the split starts the next batch
+            if prealloc:
+                split += ["batch = [None] * max_len", "batch[0] = record", "i = 1"]
+            else:
+                split += ["batch = [record]", "append = batch.append"]
+            if max_batch_size:
+                split += ["cur = size"]
+            split += ["continue"]
+        else:
+            # The size of the next batch starts from the pushed back record
+            split += ["self._pushback = record", "return batch"]
+
+        if not prealloc:
+            lines += ["    append = batch.append"]
+        lines += ["    for record in it:"]
+        if calc_size:
+            lines += [f"        size = {size_fn}(record)"]
+        if max_record_size:
+            lines += ["        if size > max_rec:"]
+            if skip:
+                lines += ["            continue"]
+            else:
+                lines += ["            raise RecordSizeExceeded(record)"]
+        if max_batch_len:
+            if prealloc:
+                lines += ["        if i >= max_len:"]
+            else:
+                lines += ["        if len(batch) >= max_len:"]
+            lines += [f"            {line}" for line in split]
+        if max_batch_size:
+            lines += [
+                "        new_batch_size = cur + size",
+                "        if new_batch_size > max_bs:",
+            ]
+            lines += [f"            {line}" for line in split]
+            lines += ["        cur = new_batch_size"]
+        if prealloc:
+            lines += ["        batch[i] = record", "        i += 1"]
+        else:
+            lines += ["        append(record)"]
+
+    if prealloc:
+        lines += ["    del batch[i:]"]
+    lines += [
+        "    self._iter_state = _EXHAUSTED",
+        "    self._compiled_next = _stop_iteration",
+    ]
+    if all_batches:
+        lines += ["    result.append(batch)", "    return result"]
+    else:
+        lines += ["    return batch"]
+
+    namespace: Dict[str, Any] = {
+        "RecordSizeExceeded": RecordSizeExceeded,
+        "_MISSING": _MISSING,
+        "_EXHAUSTED": _EXHAUSTED,
+        "_stop_iteration": _stop_iteration,
+    }
+    code = compile("\n".join(lines), "<badger_batcher._compile_next>", "exec")
+    exec(code, namespace)
+    return namespace["_next"]
 
 
 class Batcher:
@@ -67,14 +250,37 @@ class Batcher:
     ['record: 0', 'record: 1']
     """
 
+    __slots__ = (
+        "records",
+        "max_batch_len",
+        "max_record_size",
+        "max_batch_size",
+        "size_calc_fn",
+        "when_record_size_exceeded",
+        "_exceed_mode",
+        "reuse_batch",
+        "_iter_state",
+        "_pushback",
+        "_batch_buf",
+        "_reuse",
+        "_fast_path",
+        "_compiled_next",
+    )
+
     records: Iterable[Any]
     max_batch_len: Optional[int]
-    max_record_size = Optional[int]
-    max_batch_size = Optional[int]
-    size_calc_fn = Optional[Callable[[Any], int]]
-    when_record_size_exceeded = Optional[str]
-    _iter_state: Optional[CacheIterator]
-    _batch_cur_size: int
+    max_record_size: Optional[int]
+    max_batch_size: Optional[int]
+    size_calc_fn: Optional[Callable[[Any], int]]
+    when_record_size_exceeded: str
+    _exceed_mode: int
+    reuse_batch: bool
+    _iter_state: Iterator[Any]
+    _pushback: Any
+    _batch_buf: List[Any]
+    _reuse: bool
+    _fast_path: bool
+    _compiled_next: Callable[[Any, Iterator[Any]], List[Any]]
 
     def __init__(
         self,
@@ -84,6 +290,7 @@ class Batcher:
         max_batch_size=None,
         size_calc_fn=None,
         when_record_size_exceeded="raises",
+        reuse_batch=False,
     ):
         """
         :param records: Iterable of records to batch
@@ -92,6 +299,9 @@ class Batcher:
             if used size_calc_fn must be defined
         :param size_calc_fn: function from record type T -> int used to calculated size
         :param when_record_size_exceeded: What to do when when size limit is exceeded
+        :param reuse_batch: If True, iterating Batcher returns the same list object
+            for every batch, and the returned batch is invalidated
+            when the next batch is requested. batches() is not affected.
         :raises ValueError: in case of incompatible parameters
         """
         self.records = records
@@ -105,134 +315,189 @@ class Batcher:
         self.max_batch_size = max_batch_size
         self.size_calc_fn = size_calc_fn
 
-        exceed_acceptable_values = ["raises", "skip"]
-        if when_record_size_exceeded not in exceed_acceptable_values:
+        if when_record_size_exceeded not in _EXCEED_MODES:
             raise ValueError(
-                f"when_record_size_exceeded should be in: {exceed_acceptable_values}"
+                f"when_record_size_exceeded should be in: {list(_EXCEED_MODES)}"
             )
         self.when_record_size_exceeded = when_record_size_exceeded
+        self._exceed_mode = _EXCEED_MODES[when_record_size_exceeded]
 
-        self._iter_state = None
-        self._batch_cur_size = 0
+        self.reuse_batch = reuse_batch
 
-    def _check_max_batch_len(self, batch) -> bool:
-        """
-        Returns True if record size exceeds the given threshold,
-        False otherwise.
+        self._iter_state = _EXHAUSTED
+        self._compiled_next = _stop_iteration
+        self._pushback = _MISSING
+        self._batch_buf = []
+        self._reuse = reuse_batch
+        self._fast_path = False
 
-        :param batch: batch state before appending the new record
-        :return:
+    def __iter__(self):
         """
-        max_len = self.max_batch_len
-        if max_len:
-            return len(batch) >= max_len
-        else:
-            return False
+        Makes Batcher iterable
 
-    def _check_max_record_size(self, record) -> bool:
-        """
-        Returns True if record size exceeds the given threshold,
-        False otherwise.
+        The record iterator is stored to self._iter_state, as __next__ is continuing
+        the iteration of it multiple times, but we don't want it to start all over
+        again.
 
-        :param record: any record
-        :return:
+        Batcher is its own iterator, so only one iteration can be in progress
+        at a time: calling iter() again, or batches(), restarts the iteration
+        from the current position of the records.
         """
-        max_size = self.max_record_size
-        if max_size:
-            # mypy ignore: https://github.com/python/mypy/issues/708
-            return self.size_calc_fn(record) > max_size  # type: ignore
-        else:
-            return False
+        self._start_iteration(reuse_batch=self.reuse_batch)
+        self._select_next()
+        return self
 
-    def _check_new_batch_size(self, record: Any) -> bool:
+    def _start_iteration(self, reuse_batch: bool):
         """
-        Returns True if batch size exceeds the given threshold,
-        False otherwise.
+        Resets the iteration state of Batcher.
 
-        Also fetches and updates batch size in self._batch_cur_size.
+        The __next__ implementation is selected separately with _select_next,
+        as batches() doesn't need it for all the paths.
 
-        :param record: any record
-        :return:
+        :param reuse_batch: whether __next__ should reuse the same batch list
         """
-        max_size = self.max_batch_size
-        if max_size:
-            new_batch_size = self._batch_cur_size + self.size_calc_fn(record)
-            if new_batch_size > max_size:
-                return True
-            else:
-                self._batch_cur_size = new_batch_size
-                return False
+        self._iter_state = iter(self.records)
+        self._pushback = _MISSING
+        self._reuse = reuse_batch
+        # Batching only by len is fixed-size chunking, which islice can do in C
+        self._fast_path = bool(
+            self.max_batch_len and not self.max_record_size and not self.max_batch_size
+        )
+
+    def _select_next(self):
+        """
+        Selects the __next__ implementation for the started iteration
+        to self._compiled_next.
+
+        The implementation is stored as a plain function and called with self,
+        as a method bound to self and stored on self would be a reference cycle.
+        """
+        if self._fast_path:
+            self._compiled_next = Batcher._first_fixed_len
         else:
-            return False
+            self._compiled_next = _compile_next(
+                max_batch_len=bool(self.max_batch_len),
+                max_record_size=bool(self.max_record_size),
+                max_batch_size=bool(self.max_batch_size),
+                size_is_len=self.size_calc_fn is len,
+                skip=self._exceed_mode == _SKIP,
+                reuse_batch=self._reuse,
+                prealloc=self._prealloc(self._reuse),
+            )
 
-    def __iter__(self):
+    def _prealloc(self, reuse_batch: bool) -> bool:
         """
-        Makes Batcher iterable
+        Returns True if the generated loop should preallocate the batch.
 
-        Passes a generator to CacheIteration, as __next__ is starting iteration of
-        _iter_state multiple times, but we don't want it to start all over again.
+        With known max len, the batch can be filled by index without resizing.
+        With max_batch_size, batches are often split before max len is reached,
+        and allocating and trimming max len slots for each batch costs more
+        than appending.
+
+        :param reuse_batch: whether self._batch_buf is used as the batch
         """
-        self._iter_state = CacheIterator(item for item in self.records)
-        return self
+        max_len = self.max_batch_len
+        return bool(
+            max_len
+            and max_len <= _MAX_PREALLOCATED_LEN
+            and not self.max_batch_size
+            and not reuse_batch
+        )
 
     def __next__(self):
         """
-        Iterate Batcher's records iteration state with CacheIterator self._iter_state.
-        CacheIterator is used to store previous value of the record iterator
-        before batch splitting condition checks,
-        as when split condition is met, the record should be moved to the next batch.
-        This is achieved by retrieving the previous value from CacheIterator
-        prev-property in the beginning of the loop.
+        Iterate Batcher's records iteration state self._iter_state.
+        When split condition is met, the record that triggered the split
+        should be moved to the next batch. This is achieved by storing
+        the record to the one record pushback slot self._pushback
+        and retrieving it in the beginning of the next call.
 
         If split conditions are met, a batch is returned before self._iter_state
         is consumed.
-        Otherwise, batch is returned when all records are consumed from CacheIterator.
+        Otherwise, batch is returned when all records are consumed from
+        self._iter_state.
+
+        The implementation is selected to self._compiled_next in the beginning
+        of the iteration. The per-record loop is generated by _compile_next,
+        so that only the split conditions in use are checked.
+        When self._iter_state is consumed, self._compiled_next is replaced
+        with _stop_iteration.
 
         :return: List[Any] next batch
         :raises StopIteration: if self._iter_state is consumed.
-        :raises NotImplementedError: in case of non-valid value
-            for self.when_record_size_exceeded
         :raises RecordSizeExceeded if self.when_record_size_exceeded is `raises`
             and threshold is exceeded
         """
-        if not self._iter_state:
-            raise StopIteration
+        return self._compiled_next(self, self._iter_state)
 
-        # Handle cached record from the previous batch
-        if cache := self._iter_state.prev:
-            batch = [cache]
+    def _take_fixed_len(self, it: Iterator[Any]) -> List[Any]:
+        """
+        Takes the next batch for the case when only max_batch_len is used.
+
+        :param it: records iterator
+        :return: List[Any] next batch, empty if it is consumed
+        """
+        max_len = self.max_batch_len
+        chunk = islice(it, max_len)  # type: ignore
+        if self._reuse:
+            batch = self._batch_buf
+            batch.clear()
+            batch.extend(chunk)
         else:
-            batch = []
-        if self.max_batch_size:
-            self._batch_cur_size = self.size_calc_fn(cache) if cache else 0
-
-        if self._iter_state:
-            for record in self._iter_state:
-
-                if self._check_max_record_size(record):
-                    if self.when_record_size_exceeded == "raises":
-                        raise RecordSizeExceeded(
-                            f"The following record exceeded the size limit: {record}"
-                        )
-                    elif self.when_record_size_exceeded == "skip":
-                        continue
-                    else:
-                        raise NotImplementedError(
-                            f"Value `{self.when_record_size_exceeded}` not supported "
-                            f"for when_record_size_exceeded"
-                        )
-
-                if self._check_max_batch_len(batch):
-                    return batch
-                elif self._check_new_batch_size(record):
-                    return batch
-                else:
-                    batch.append(record)
-
-        self._iter_state = None
-        self._batch_cur_size = 0
+            batch = list(chunk)
+
+        if len(batch) < max_len:  # type: ignore
+            self._iter_state = _EXHAUSTED
+            self._compiled_next = _stop_iteration
+        return batch
+
+    def _first_fixed_len(self, it: Iterator[Any]) -> List[Any]:
+        """
+        __next__ implementation for the first batch when only max_batch_len is used.
+
+        Empty records are batched to a single empty batch.
+
+        :param it: records iterator
+        :return: List[Any] first batch
+        """
+        self._compiled_next = Batcher._next_fixed_len
+        return self._take_fixed_len(it)
+
+    def _next_fixed_len(self, it: Iterator[Any]) -> List[Any]:
+        """
+        __next__ implementation for the following batches
+        when only max_batch_len is used.
+
+        :param it: records iterator
+        :return: List[Any] next batch
+        :raises StopIteration: if self._iter_state is consumed.
+        """
+        batch = self._take_fixed_len(it)
+        if not batch:
+            raise StopIteration
         return batch
 
+    def _batches_fast(self) -> List[List[Any]]:
+        """
+        batches() implementation that collects all batches in one generated loop,
+        instead of calling __next__ for each batch.
+
+        :return: batches of records in a list of lists
+        :raises RecordSizeExceeded if self.when_record_size_exceeded is `raises`
+            and threshold is exceeded
+        """
+        batches_fn = _compile_next(
+            max_batch_len=bool(self.max_batch_len),
+            max_record_size=bool(self.max_record_size),
+            max_batch_size=bool(self.max_batch_size),
+            size_is_len=self.size_calc_fn is len,
+            skip=self._exceed_mode == _SKIP,
+            reuse_batch=False,
+            prealloc=self._prealloc(reuse_batch=False),
+            all_batches=True,
+        )
+        return batches_fn(self, self._iter_state)
+
     def batches(self) -> List[List[Any]]:
         """
         Get all batches.
@@ -242,4 +507,15 @@ class Batcher:
 
         :return: batches of records in a list of lists
         """
-        return list(iter(self))
+        # The batches are retained, so they can't share the same list
+        self._start_iteration(reuse_batch=False)
+        if not self._fast_path:
+            return self._batches_fast()
+
+        self._select_next()
+        batches = []
+        try:
+            while True:
+                batches.append(next(self))
+        except StopIteration:
+            return batches
@@ -1,2 +1,19 @@
+from typing import Any
+
+
 class RecordSizeExceeded(Exception):
-    pass
+    """
+    Raised when a record exceeds max record size.
+
+    The record is stored as is, and formatted to the message only when
+    the exception is converted to str.
+    """
+
+    record: Any
+
+    def __init__(self, record: Any):
+        super().__init__(record)
+        self.record = record
+
+    def __str__(self):
+        return f"The following record exceeded the size limit: {self.record}"
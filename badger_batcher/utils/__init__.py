@@ -1 +0,0 @@
-from .iterating import CacheIterator  # noqa: F401
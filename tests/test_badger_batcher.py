@@ -2,6 +2,9 @@
 
 """Tests for `badger_batcher` package."""
 
+import gc
+import weakref
+
 import pytest  # noqa: F401
 from badger_batcher import Batcher
 from badger_batcher.errors import RecordSizeExceeded
@@ -175,3 +178,259 @@ def test_max_encode_before_batching():
         [b"b\x00", b"c\x00c\x00c\x00"],
         [b"d\x00d\x00", b"e\x00"],
     ]
+
+
+def test_reuse_batch_iteration():
+    records = [f"record: {rec}" for rec in range(5)]
+    batcher = Batcher(records, max_batch_len=2, reuse_batch=True)
+    batch_ids = set()
+    batched_records = []
+    for batch in batcher:
+        batch_ids.add(id(batch))
+        batched_records.append(list(batch))
+    assert len(batch_ids) == 1
+    assert batched_records == [
+        ["record: 0", "record: 1"],
+        ["record: 2", "record: 3"],
+        ["record: 4"],
+    ]
+
+
+def test_reuse_batch_batches():
+    records = [f"record: {rec}" for rec in range(5)]
+    batcher = Batcher(records, max_batch_len=2, reuse_batch=True)
+    batched_records = batcher.batches()
+    assert batched_records == [
+        ["record: 0", "record: 1"],
+        ["record: 2", "record: 3"],
+        ["record: 4"],
+    ]
+
+
+def test_max_batch_len_only_exact_multiple():
+    records = (f"record: {rec}" for rec in range(4))
+    batcher = Batcher(records, max_batch_len=2)
+    batched_records = batcher.batches()
+    assert batched_records == [
+        ["record: 0", "record: 1"],
+        ["record: 2", "record: 3"],
+    ]
+
+
+def test_falsy_records():
+    records = [b"", b"x"]
+    batcher = Batcher(records, max_batch_len=1)
+    assert batcher.batches() == [[b""], [b"x"]]
+
+    records = [b"", b"x", b"", b"yy", 0, None]
+    batcher = Batcher(
+        (record for record in records),
+        max_batch_len=2,
+        max_batch_size=2,
+        size_calc_fn=lambda r: len(r) if r else 0,
+    )
+    assert batcher.batches() == [[b"", b"x"], [b"", b"yy"], [0, None]]
+
+
+def test_record_size_exceeded_record():
+    records = [b"aaaa", b"bb", b"ccccc", b"d"]
+    batcher = Batcher(records, max_record_size=4, size_calc_fn=len)
+    with pytest.raises(RecordSizeExceeded) as exc_info:
+        _ = batcher.batches()
+    assert exc_info.value.record == b"ccccc"
+    assert str(exc_info.value) == (
+        "The following record exceeded the size limit: b'ccccc'"
+    )
+
+
+SIZE_LIMIT_CASES = [
+    (
+        [b"aaaa", b"bb", b"ccccc", b"d"],
+        dict(max_record_size=5, size_calc_fn=len),
+        [[b"aaaa", b"bb", b"ccccc", b"d"]],
+    ),
+    (
+        [b"aaaa", b"bb", b"ccccc", b"d"],
+        dict(max_record_size=4, size_calc_fn=len, when_record_size_exceeded="skip"),
+        [[b"aaaa", b"bb", b"d"]],
+    ),
+    (
+        [b"aaaa", b"bb", b"ccccc", b"d"],
+        dict(
+            max_batch_len=2,
+            max_record_size=4,
+            size_calc_fn=len,
+            when_record_size_exceeded="skip",
+        ),
+        [[b"aaaa", b"bb"], [b"d"]],
+    ),
+    (
+        [b"aaaa", b"b", b"ccc", b"toolargeforbatch", b"dd", b"e"],
+        dict(max_batch_size=5, size_calc_fn=len, when_record_size_exceeded="skip"),
+        [[b"aaaa", b"b"], [b"ccc", b"dd"], [b"e"]],
+    ),
+    (
+        [b"a", b"a", b"a", b"b", b"ccc", b"bbbb", b"dd", b"e"],
+        dict(
+            max_batch_len=3,
+            max_record_size=3,
+            max_batch_size=5,
+            size_calc_fn=len,
+            when_record_size_exceeded="skip",
+        ),
+        [[b"a", b"a", b"a"], [b"b", b"ccc"], [b"dd", b"e"]],
+    ),
+    (
+        [b"a", b"a", b"a"],
+        dict(max_batch_len=2, max_batch_size=5, size_calc_fn=len),
+        [[b"a", b"a"], [b"a"]],
+    ),
+    ([], dict(max_batch_size=5, size_calc_fn=len), [[]]),
+]
+
+
+@pytest.mark.parametrize("records, kwargs, expected", SIZE_LIMIT_CASES)
+def test_size_limits_with_list_tuple_and_generator(records, kwargs, expected):
+    inputs = [
+        lambda: list(records),
+        lambda: tuple(records),
+        lambda: (record for record in records),
+    ]
+    for make_records in inputs:
+        assert Batcher(make_records(), **kwargs).batches() == expected
+        assert [list(batch) for batch in Batcher(make_records(), **kwargs)] == (
+            expected
+        )
+
+
+def test_max_record_size_raises_streamed_records():
+    records = (record for record in [b"aa", b"bb", b"cc", b"toolarge", b"d"])
+    batcher = Batcher(records, max_batch_len=2, max_record_size=4, size_calc_fn=len)
+    it = iter(batcher)
+    assert next(it) == [b"aa", b"bb"]
+    with pytest.raises(RecordSizeExceeded) as exc_info:
+        next(it)
+    assert exc_info.value.record == b"toolarge"
+
+
+def test_max_record_size_raises_tuple_records():
+    records = (b"aa", b"bb", b"toolarge", b"d")
+    batcher = Batcher(records, max_batch_size=4, size_calc_fn=len)
+    with pytest.raises(RecordSizeExceeded) as exc_info:
+        _ = batcher.batches()
+    assert exc_info.value.record == b"toolarge"
+
+
+def test_max_record_size_raises_stops_at_first_exceeding_record():
+    sized_records = []
+
+    def size_calc_fn(record):
+        sized_records.append(record)
+        return len(record)
+
+    records = [b"aa", b"toolarge", b"d"]
+    batcher = Batcher(records, max_batch_size=4, size_calc_fn=size_calc_fn)
+    with pytest.raises(RecordSizeExceeded):
+        _ = batcher.batches()
+    assert sized_records == [b"aa", b"toolarge"]
+
+
+@pytest.mark.parametrize("when_record_size_exceeded", ["raises", "skip"])
+def test_max_batch_len_and_max_record_size_streamed(when_record_size_exceeded):
+    # max_batch_len without max_batch_size fills preallocated batches
+    records = [b"a", b"bb", b"ccc", b"dd", b"e", b"toolarge", b"f"]
+
+    def make_batcher():
+        return Batcher(
+            (record for record in records),
+            max_batch_len=2,
+            max_record_size=3,
+            size_calc_fn=len,
+            when_record_size_exceeded=when_record_size_exceeded,
+        )
+
+    it = iter(make_batcher())
+    assert [next(it), next(it)] == [[b"a", b"bb"], [b"ccc", b"dd"]]
+    if when_record_size_exceeded == "skip":
+        assert next(it) == [b"e", b"f"]
+        with pytest.raises(StopIteration):
+            next(it)
+        assert make_batcher().batches() == [
+            [b"a", b"bb"],
+            [b"ccc", b"dd"],
+            [b"e", b"f"],
+        ]
+    else:
+        with pytest.raises(RecordSizeExceeded):
+            next(it)
+        with pytest.raises(RecordSizeExceeded):
+            make_batcher().batches()
+
+
+def test_only_max_record_size_skip_streamed():
+    records = [b"aaaa", b"bb", b"ccccc", b"d"]
+    batcher = Batcher(
+        (record for record in records),
+        max_record_size=4,
+        size_calc_fn=len,
+        when_record_size_exceeded="skip",
+    )
+    assert list(batcher) == [[b"aaaa", b"bb", b"d"]]
+
+    batcher = Batcher(
+        (record for record in records),
+        max_record_size=4,
+        size_calc_fn=len,
+        when_record_size_exceeded="skip",
+    )
+    assert batcher.batches() == [[b"aaaa", b"bb", b"d"]]
+
+
+def test_max_batch_len_and_max_record_size_skip_streamed():
+    records = [b"aaaa", b"bb", b"ccccc", b"d", b"eeeeee", b"f", b"g"]
+    expected = [[b"aaaa", b"bb"], [b"d", b"f"], [b"g"]]
+    batcher = Batcher(
+        (record for record in records),
+        max_batch_len=2,
+        max_record_size=4,
+        size_calc_fn=len,
+        when_record_size_exceeded="skip",
+    )
+    assert list(batcher) == expected
+
+    batcher = Batcher(
+        (record for record in records),
+        max_batch_len=2,
+        max_record_size=4,
+        size_calc_fn=len,
+        when_record_size_exceeded="skip",
+    )
+    assert batcher.batches() == expected
+
+
+class _Records(list):
+    pass
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        dict(max_batch_len=2),
+        dict(max_batch_len=2, max_batch_size=4, size_calc_fn=len),
+    ],
+)
+def test_partially_iterated_batcher_freed_without_gc(kwargs):
+    records = _Records([b"a", b"b", b"c", b"d", b"e"])
+    records_ref = weakref.ref(records)
+    batcher = Batcher(records, **kwargs)
+    it = iter(batcher)
+    assert next(it) == [b"a", b"b"]
+
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        del records, batcher, it
+        assert records_ref() is None
+    finally:
+        if gc_enabled:
+            gc.enable()